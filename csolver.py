@@ -34,35 +34,99 @@
 
 from z3 import *
 import sys
+import argparse
+import functools
+import multiprocessing
 import math
-import pandas as pd
+import numpy as np
 import os.path
 import time
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, without it the compiled helpers run as plain python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
 # symbols to use for drawing the circuit to the file
 CONTROL_DOT = "o"
 NOT_GATE = "X"
 PIPE = "|"
 
+# codes used for the cells of the circuit matrix while it is being built,
+# CELL_CHARS maps each code back to the symbol that gets drawn
+EMPTY_CODE = 0
+CONTROL_CODE = 1
+NOT_CODE = 2
+PIPE_CODE = 3
+CELL_CHARS = np.array(["-", CONTROL_DOT, NOT_GATE, PIPE])
+
 
 # solves for the circuit given by the truth table in filename
-# using num_gates gates/bits 
-def solve_table(filename, num_gates, out_file):
-    s = Solver()
+# using num_gates gates/bits, and writes it to out_file. If min_gates is
+# given, every gate count from min_gates up to num_gates is tried in turn,
+# and the smallest one that works is used. With more than one worker, that
+# many solvers with different random seeds race each other, and the first
+# one to finish gives the answer
+def solve_table(filename, num_gates, out_file, min_gates=None, workers=1, debug=False):
+    if workers > 1:
+        # z3 contexts can't be safely forked, so every worker is a fresh
+        # process that builds its own solver
+        solve = functools.partial(solve_with_seed, filename, num_gates, min_gates, debug)
+        with multiprocessing.get_context("spawn").Pool(workers) as pool:
+            # leaving the with block terminates the workers still running
+            result = next(pool.imap_unordered(solve, range(workers)))
+    else:
+        result = find_circuit(filename, num_gates, min_gates, debug=debug)
+
+    (found, num_input_bits, num_output_bits, m, variables) = result
+    if not found:
+        print("Model is not satisfiable")
+        return (False, 0, 0, 0)
+    output_file = open(out_file, "w+")
+    for d in variables:
+        output_file.write(d + "\n")
+    output_file.close()
+    return (True, num_input_bits, num_output_bits, m)
+
+# runs find_circuit with the given random seed for the SAT solver
+# worker function for the parallel mode of solve_table
+def solve_with_seed(filename, num_gates, min_gates, debug, seed):
+    return find_circuit(filename, num_gates, min_gates, seed, debug)
+
+# does the work of solve_table, returning whether a circuit was found,
+# the number of input, output bits and gates it uses, and the names of
+# the c and n variables that are set in it. In debug mode, the clauses
+# that make an unsatisfiable system conflict are printed
+def find_circuit(filename, num_gates, min_gates=None, seed=None, debug=False):
+    # the problem is purely boolean, so skip z3's automatic configuration
+    # and relevancy tracking, which only slow down the incremental core
+    set_param('smt.auto_config', False)
+    set_param('smt.relevancy', 0)
+    if seed is not None:
+        set_param('sat.random_seed', seed)
+    # QF_FD hands the problem to z3's SAT core, which is much faster than
+    # the general solver on finite domain problems like this one
+    s = SolverFor("QF_FD")
     # first read in from the filename, store the truth table in a 2d array
     # disregard the first column (we can get input from row number to binary)
     print("Reading csv File...")
-    truth_table = pd.read_csv(filename, header=None).iloc[:,1:]
-    truth_table = truth_table.to_numpy()
+    # the number of columns comes from the first line, so numpy can
+    # parse just the output columns straight into integers
+    with open(filename) as f:
+        num_cols = len(f.readline().split(',')) - 1
+    truth_table = np.loadtxt(filename, delimiter=',', dtype=np.int8,
+                             usecols=range(1, num_cols + 1), ndmin=2)
     num_gates = int(num_gates)
+    if min_gates is None:
+        min_gates = num_gates
+    min_gates = int(min_gates)
 
     num_rows = len(truth_table)
-    num_cols = len(truth_table[0])
-    
-    # convert all the elements into integers
-    for i in range(num_rows):
-        for j in range(num_cols):
-            truth_table[i][j] = int(truth_table[i][j])
+
     # number of output bits is just the length of the inner array
     num_output_bits = num_cols
     # number of input bits is the number of bits necessary to represent
@@ -70,45 +134,59 @@ def solve_table(filename, num_gates, out_file):
     num_input_bits = math.ceil(math.log2(num_rows)) 
     
     print("Setting up arrays...")
-    # make the c two dimensional array
-    c = []
-    for i in range(num_gates):
-        c.append([])
-        for j in range(num_gates):
-            c[i].append(Bool("c_"+str(i)+"_"+str(j)))
-
-    # Now for the array v, also 2d
-    v = []
-    for i in range(num_gates):
-        v.append([])
-        for j in range(num_rows):
-            v[i].append(Bool("v_" + str(i) + "_" + str(j)))
+    # allocate each set of variables in bulk as flat vectors, and index
+    # into them with the small accessor functions below
+    # gates cannot be controlled on gates that are above them, or themselves,
+    # so only C(i, j) with j < i exists. It is stored at index
+    # i * (i - 1) / 2 + j of the flat vector
+    c = BoolVector("c", num_gates * (num_gates - 1) // 2)
+    def C(i, j):
+        return c[i * (i - 1) // 2 + j]
+
+    # Now for the v's, V(i, t) is the output of gate i on input t
+    v = BoolVector("v", num_gates * num_rows)
+    def V(i, t):
+        return v[i * num_rows + t]
 
     # and the n array
-    n = []
-    for i in range(num_gates):
-        n.append(Bool("n_"+str(i)))
+    n = BoolVector("n", num_gates)
+
+    # G(i, t) stands in for the conjunction in the gate evolution clause of
+    # gate i on input t, which keeps the xor in that clause between two literals
+    # gate 0 has no conjunction, so G(0, t) is never used
+    g = BoolVector("g", num_gates * num_rows)
+    def G(i, t):
+        return g[i * num_rows + t]
+
+    # activation literals, a[m] selects a circuit that uses m gates
+    # the variables above are shared by every gate count, so whatever z3
+    # learns while ruling out m gates is kept when it tries m + 1
+    a = BoolVector("a", num_gates + 1)
+    # there needs to be at least one gate per output bit
+    gate_counts = range(max(min_gates, num_output_bits), num_gates + 1)
 
     print("Adding constraints...\n")
     # Now to add the constraints to the system
-    # gates cannot be controlled on gates that are above them, or themselves
-    for i in range(num_gates):
-        for j in range(i, num_gates):
-            s.add(c[i][j] == False)
-    
-
+    # the clauses of each phase are collected and handed to z3 in one call
+    # each clause gets a (phase, gate, input) tag, which is only used in
+    # debug mode to explain an unsatisfiable system
+    clauses = []
+    tags = []
+    tracked = {} if debug else None
     # Now the output bits must math the truth table. The value of the output bits is
     # just the output of the last n gates, where n is the number of output bits
-    # Loop through the last num_output_bits gates, and make sure their outputs match
-    for gate in range(num_gates - num_output_bits, num_gates):
-        for inp in range(num_rows):
-            # check the table to see what the output of the correct
-            # output bit is for the given input
-            table_out = truth_table[inp][gate - (num_gates - num_output_bits)]
-            if (table_out == 0):
-                s.add(v[gate][inp] == False)
-            else:
-                s.add(v[gate][inp] == True)
+    # Which gates those are depends on the gate count, so for each count m
+    # loop through the last num_output_bits gates, and make sure their outputs
+    # match whenever a[m] is set
+    TRUE, FALSE = BoolVal(True), BoolVal(False)
+    for m in gate_counts:
+        # each column of the table gives the outputs of one output bit
+        for k in range(num_output_bits):
+            gate = m - num_output_bits + k
+            for inp, bit in enumerate(truth_table[:, k].tolist()):
+                clauses.append(Implies(a[m], V(gate, inp) == (TRUE if bit else FALSE)))
+                tags.append(("output", gate, inp))
+    add_clauses(s, clauses, tags, tracked)
 
     # gate evolution clause
     # this is the most complicated of the clauses
@@ -116,90 +194,121 @@ def solve_table(filename, num_gates, out_file):
     # not on the bit, as well as the values of all bits preceding it
     # where we filter the ones that have controls on them
     # in boolean form:
-    # v[i][t] = n[i] xor ((v[i-1][t] or not c[i][i-1]) and (v[i-2][t] or not c[i][i-2]) and  ... and (v[0][t] or not c[i][0]))
+    # V(i, t) = n[i] xor ((V(i-1, t) or not C(i, i-1)) and (V(i-2, t) or not C(i, i-2)) and  ... and (V(0, t) or not C(i, 0)))
     
-    # for every gate
-    for i in range(num_gates):
+    # a gate only depends on the gates before it, so these clauses hold
+    # for every gate count and don't need an activation literal
+    # the first gate has no gates before it, so its conjunction is just True
+    # and V(0, t) = n[0] xor True xor (input bit 0 of t), which is n[0] when
+    # the input bit is set and not n[0] otherwise
+    if num_gates > 0:
+        not_n_0 = Not(n[0])
+        for inp in range(num_rows):
+            bit = num_input_bits > 0 and (inp >> (num_input_bits - 1)) & 1
+            clauses.append(V(0, inp) == (n[0] if bit else not_n_0))
+            tags.append(("evolution", 0, inp))
+
+    # for every other gate
+    for i in range(1, num_gates):
+        # the negated controls are the same for every input, so make them once
+        nc_i = [Not(C(i, j)) for j in range(i)]
+        # now we make sure that the input values are correctly set
+        # xor with a set input bit is the same as flipping the not, so find
+        # the inputs where bit i is set once, and use Not(n[i]) for those
+        ones = set()
+        if i < num_input_bits:
+            shift = num_input_bits - 1 - i
+            ones = {inp for inp in range(num_rows) if (inp >> shift) & 1}
+        not_n_i = Not(n[i])
+        # the conjunction over all the gates below it has the same shape for
+        # every input, so build it once with placeholders for the v's, and
+        # fill in the v's for each input
+        template = And([Or(Var(j, BoolSort()), nc_i[j]) for j in range(i)])
         # for every input
         for inp in range(num_rows):
+            clauses.append(G(i, inp) == substitute_vars(template, *[V(j, inp) for j in range(i)]))
+            tags.append(("conjunction", i, inp))
             # start with the existence of the not
-            clause = n[i]
-            temp = True
-            #loop through all gates below it
-            for count in range(1, i + 1):
-                temp = And(temp, Or(v[i-count][inp], Not(c[i][i-count])))
-
-            clause = Xor(clause, temp)
-            # now we make sure that the input values are correctly set
-            if i < num_input_bits:
-                input_val = False
-                if (bin(inp)[2:].zfill(num_input_bits)[i] == '1'):
-                    input_val = True
-                clause = Xor(clause, input_val)
-
-            s.add(v[i][inp] == clause)
+            clause = Xor(not_n_i if inp in ones else n[i], G(i, inp))
+            clauses.append(V(i, inp) == clause)
+            tags.append(("evolution", i, inp))
+    add_clauses(s, clauses, tags, tracked)
+
+    # symmetry breaking
+    # two neighbouring ancillary gates where the second isn't controlled on
+    # the first can be swapped without changing what the circuit does, so we
+    # only allow the order where the controls and not of the first gate are
+    # lexicographically no larger than those of the second
+    # which gates are ancillary depends on the gate count, so the ordering
+    # for gates i and i + 1 is only active for counts where both are ancillary
+    for i in range(num_input_bits, num_gates - 1):
+        counts = [a[m] for m in gate_counts if i + 1 < m - num_output_bits]
+        if not counts:
+            continue
+        first = [C(i, j) for j in range(i)] + [n[i]]
+        second = [C(i + 1, j) for j in range(i)] + [n[i + 1]]
+        clauses.append(Implies(And(Or(*counts), Not(C(i + 1, i))), lex_leq(first, second)))
+        tags.append(("symmetry", i, None))
+    add_clauses(s, clauses, tags, tracked)
 
-    
-    print("Checking satisfiability...\n")
     # Now that all clauses have been input, we can use z3 to solve the model
-    if (s.check() == sat):
-        print("Model is satisfiable!")
-        model = s.model()
-        output_file = open(out_file, "w+")
-        #print(s.assertions())
-        for d in model:
-            if str(model[d]) == "True" and not "v" in str(d):
-                output_file.write(str(d) + "\n")
-        output_file.close()
+    # try each gate count in turn, stopping at the first one that works
+    for m in gate_counts:
+        print("Checking satisfiability with " + str(m) + " gates...\n")
+        if (s.check(a[m]) == sat):
+            print("Model is satisfiable!")
+            model = s.model()
+            variables = []
+            # only the gates in use are part of the circuit
+            for i in range(m):
+                if is_true(model.eval(n[i])):
+                    variables.append(str(n[i]))
+                for j in range(i):
+                    if is_true(model.eval(C(i, j))):
+                        variables.append(str(C(i, j)))
+            return (True, num_input_bits, num_output_bits, m, variables)
     # if the system isn't satisfiable
-    else:
-        print("Model is not satisfiable")
-        return (False, 0, 0)
-    return (True, num_input_bits, num_output_bits)
+    # in debug mode, say which clauses conflict for the largest gate count
+    if debug and len(gate_counts) > 0:
+        print("Conflicting clauses with " + str(gate_counts[-1]) + " gates:")
+        for p in s.unsat_core():
+            if str(p) in tracked:
+                (phase, gate, inp) = tracked[str(p)]
+                if inp is None:
+                    print("  " + phase + " clause for gate " + str(gate))
+                else:
+                    print("  " + phase + " clause for gate " + str(gate) + ", input " + str(inp))
+    return (False, 0, 0, 0, [])
 
 # draws the generated circuit from the output of the truth table solver
 # circuit is drawn into the outfile, and labels the input, ancilla,
 # and output bits. It also computes the gate counts used in the circuit. 
-def draw_circ(infile, outfile, num_in, num_out):
+def draw_circ(infile, outfile, num_gates, num_in, num_out):
     #read in the lines
     with open(infile) as f:
         data = f.read().splitlines()
-    data.sort()
-    nots = [i for i in data if i[0] == 'n']
-    cs = [i for i in data if i[0] == 'c']
-
-    # the circuit is always nxn where n is the max seen in the c's
-    # lets find the maximum
-    parsed_cs = [int(i.split('_')[1]) for i in cs]
-    parsed_all = [int(i.split('_')[1]) for i in data]
-
-    n = max(parsed_all) + 1  
-    #make a matrix to represent it
-    circ = [["-" for i in range(n)] for j in range(n)]
-
-    # do the nots first
-    for i in range(len(nots)):
-        parsed_not = int(nots[i].split('_')[1])
-        circ[parsed_not][0] = NOT_GATE
-
-    # do the diagonal
-    for i in range(n):
-        circ[i][i] = NOT_GATE
-
-
-    # and now the control dots
-    for i in range(len(cs)):
-        x = int(cs[i].split('_')[1])
-        y = int(cs[i].split('_')[2])
-        circ[y][x] = CONTROL_DOT
-
-    # finally, the pipes between the dots and the nots
-    for i in range(1, n):
-        for j in range(1,i):
-            if (circ[j][i] == "-"):
-                # now check if there are any 'o's above the current cell
-                if (o_above(circ, j, i)):
-                    circ[j][i] = PIPE
+    # parse every line once into a (kind, gate, control) tuple, and sort
+    # them numerically so that c__10 doesn't come before c__2
+    # c variables are named c__k, where k = x * (x - 1) / 2 + y
+    parsed = []
+    for line in data:
+        parts = line.split('__')
+        if parts[0] == 'n':
+            parsed.append(('n', int(parts[1]), None))
+        else:
+            (x, y) = unpack_control(int(parts[1]))
+            parsed.append(('c', x, y))
+    parsed.sort()
+    nots = [p[1] for p in parsed if p[0] == 'n']
+    cs = [(p[1], p[2]) for p in parsed if p[0] == 'c']
+
+    # the circuit is always nxn where n is the number of gates
+    n = num_gates
+    nots_idx = np.array(nots, dtype=np.int64)
+    cs_ij = np.array(cs, dtype=np.int64).reshape(-1, 2)
+    circ_codes = build_circ(nots_idx, cs_ij, n)
+    # turn the codes into the symbols to draw
+    circ = CELL_CHARS[circ_codes]
 
     # now write the matrix to the outfile
     f = open(outfile, "w")
@@ -212,34 +321,22 @@ def draw_circ(infile, outfile, num_in, num_out):
         else:
             f.write("|a> ")
         # write out the matrix with spacers
-        for j in range(n):
-            f.write("-")
-            f.write(circ[i][j])
-            f.write("-")
+        f.write("-" + "--".join(circ[i]) + "-")
         f.write("\n")
 
     f.write("\n\n")
     # now write out the gate counts in order
     f.write("===Gate Counts====\n")
     # compute the number of C^n NOT gates in the circuit
-    # loop through the matrix starting at 1, and count the number of o's
-    # in the column which tells what gate it is
+    # count the o's in every column starting at 1, which tells what gate it is,
+    # then count how many columns have each number of o's
+    num_os = (circ_codes[:, 1:] == CONTROL_CODE).sum(axis=0)
+    hist = np.bincount(num_os)
     gate_dict = {}
-    for i in range(1,n):
-        num_os = 0
-        for j in range(n):
-            if (circ[j][i] == CONTROL_DOT):
-                num_os += 1
-            
-        # now we have the number of controls in the gate, so we know what gate it is
+    for k in range(len(hist)):
         # n controls make it a C^nNot gate
-        gate_name = ("C" * num_os) + "NOT"
-        
-        # add to the dictionary
-        if (gate_name in gate_dict):
-            gate_dict[gate_name] = gate_dict[gate_name] + 1
-        else:
-            gate_dict[gate_name] = 1
+        if (hist[k] > 0):
+            gate_dict[("C" * k) + "NOT"] = int(hist[k])
 
     # add the not gates we already have in the first column
     if ("NOT" in gate_dict):
@@ -255,43 +352,109 @@ def draw_circ(infile, outfile, num_in, num_out):
     print("Drawn circuit to file.")
     f.close()
 
-# checks if there is a control dot anywhere above the given cell
+# adds a phase's clauses to the solver and empties the clauses and tags
+# lists. Normally they all go in with a single call, but in debug mode
+# (when tracked is a dict) each clause is tracked by its own literal, and
+# tracked maps the literal's name to the clause's tag
+# helper method for the solve_table function
+def add_clauses(s, clauses, tags, tracked):
+    if tracked is None:
+        s.add(*clauses)
+    else:
+        for (clause, tag) in zip(clauses, tags):
+            p = Bool("p_" + str(len(tracked)))
+            s.assert_and_track(clause, p)
+            tracked[str(p)] = tag
+    clauses.clear()
+    tags.clear()
+
+# builds the constraint that the list of booleans xs is lexicographically
+# less than or equal to ys, where False comes before True
+# helper method for the solve_table function
+def lex_leq(xs, ys):
+    # work backwards from the last position, where the empty suffixes are equal
+    clause = BoolVal(True)
+    for x, y in zip(reversed(xs), reversed(ys)):
+        clause = Or(And(Not(x), y), And(x == y, clause))
+    return clause
+
+# builds the circuit matrix out of the bits with initial nots and the
+# (gate, control) pairs, using the cell codes above
 # helper method for the draw_circ function
-def o_above(circ, j, i):
-    for y in range(0, j):
-        if circ[y][i] == CONTROL_DOT:
-            return True
-    return False
+@njit(cache=True)
+def build_circ(nots_idx, cs_ij, n):
+    circ = np.zeros((n, n), dtype=np.int8)
+
+    # do the nots first
+    for k in range(nots_idx.shape[0]):
+        circ[nots_idx[k], 0] = NOT_CODE
+
+    # do the diagonal
+    for i in range(n):
+        circ[i, i] = NOT_CODE
+
+    # and now the control dots
+    for k in range(cs_ij.shape[0]):
+        circ[cs_ij[k, 1], cs_ij[k, 0]] = CONTROL_CODE
+
+    # finally, the pipes between the dots and the nots
+    # walk down each column, any empty cell below an 'o' gets a pipe
+    for i in range(1, n):
+        seen = False
+        for j in range(i):
+            cell = circ[j, i]
+            if cell == CONTROL_CODE:
+                seen = True
+            elif cell == EMPTY_CODE and seen:
+                circ[j, i] = PIPE_CODE
+
+    return circ
+
+# inverts the c variable indexing used by solve_table, turning the
+# index k of c__k back into the (gate, control) pair it represents
+# helper method for the draw_circ function
+def unpack_control(k):
+    x = (1 + math.isqrt(1 + 8 * k)) // 2
+    y = k - x * (x - 1) // 2
+    return (x, y)
 
 # runs the table solver and drawing, based on command line arguments
 def main():
-    if (len(sys.argv) == 4):
-        filename = sys.argv[1]
-        num_gates = sys.argv[2]
-        out_file = sys.argv[3]
-
-        # check if the input file exists and is a csv
-        if os.path.isfile(filename):
-            if filename.endswith('.csv'):
-                start_time = time.time()
-                
-                (ret, num_in, num_out) = solve_table(filename, num_gates, out_file)
-                
-                end_time = time.time()
-                
-                elapsed_time = end_time - start_time
-                print("Time elapsed: " + str(elapsed_time) + " seconds.")
-                
-                if (ret):
-                    print("Drawing circuit to file...")
-                    draw_circ(out_file, out_file, num_in, num_out)
-            else:
-                print("Please input a .csv file.")
+    parser = argparse.ArgumentParser(description="Generates a reversible circuit for a truth table.")
+    parser.add_argument("filename", help="csv file containing the truth table")
+    parser.add_argument("num_gates", type=int, help="number of gates the circuit should use")
+    parser.add_argument("out_file", help="file to write the circuit to")
+    parser.add_argument("--min-gates", type=int, default=None,
+                        help="try every gate count from this up to num_gates, using the smallest that works")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of solvers to race with different random seeds")
+    parser.add_argument("--debug", action="store_true",
+                        help="if there is no circuit, print the clauses that conflict")
+    args = parser.parse_args()
+
+    filename = args.filename
+    out_file = args.out_file
+
+    # check if the input file exists and is a csv
+    if os.path.isfile(filename):
+        if filename.endswith('.csv'):
+            start_time = time.time()
+
+            (ret, num_in, num_out, num_gates) = solve_table(filename, args.num_gates, out_file, args.min_gates, args.workers, args.debug)
+
+            end_time = time.time()
+
+            elapsed_time = end_time - start_time
+            print("Time elapsed: " + str(elapsed_time) + " seconds.")
+
+            if (ret):
+                print("Drawing circuit to file...")
+                draw_circ(out_file, out_file, num_gates, num_in, num_out)
         else:
-            print("That file does not exist.")
+            print("Please input a .csv file.")
     else:
-        print("Please input the correct number of arguments.")
-    
+        print("That file does not exist.")
+
 
 
 if __name__ == '__main__':